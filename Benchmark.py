@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is then left out
+    resource = None
+
+from CuboctSTL_v0 import *
+from Fracture_Generation import ct_template2, ct_template3, ct_template2_withholes
+
+# Geometry used by every case, the same as in Fracture_Generation.py
+STRUT_WIDTH = 0.7
+CHAMFER_FACTOR = 5
+PITCH = 15
+
+# Lattice sizes swept by the size dependent cases, a size of n is an n x n x n lattice
+SIZES = [1, 2, 5, 10, 20, 30, 50]
+
+CT_TEMPLATES = {'ct_template2': ct_template2, 'ct_template3': ct_template3,
+                'ct_template2_withholes': ct_template2_withholes}
+
+
+def _hybrid_inputs():
+    """
+    Voxels and caps for hybrid_codedstructure, set up as in Fracture_Generation.py
+    :return: list of voxel meshes, list of voxel cap geometries
+    """
+    one_voxel = voxel(STRUT_WIDTH, CHAMFER_FACTOR, PITCH)
+    two_voxel = half_voxel(STRUT_WIDTH, CHAMFER_FACTOR, PITCH)
+    three_voxel = half_voxel(STRUT_WIDTH, CHAMFER_FACTOR, PITCH)
+    three_voxel.rotate([1, 0, 0], math.radians(180))
+    translate(three_voxel, np.array([0, 0, PITCH]))
+    capmesh = cap_cuboct(STRUT_WIDTH, CHAMFER_FACTOR)
+    [cap_geo_top, cap_geo_bottom, cap_geo_right, cap_geo_left, cap_geo_back, cap_geo_front] = \
+        cap_library(STRUT_WIDTH, CHAMFER_FACTOR)
+    bottomhalf_caps = [0, cap_geo_bottom, cap_geo_right, cap_geo_left, cap_geo_back, cap_geo_front]
+    tophalf_caps = [cap_geo_top, 0, cap_geo_right, cap_geo_left, cap_geo_back, cap_geo_front]
+    return [one_voxel, two_voxel, three_voxel], [capmesh, bottomhalf_caps, tophalf_caps]
+
+
+def _template(key):
+    """
+    :param key: lattice size (integer) or the name of a CT template in CT_TEMPLATES
+    :return: template numpy array
+    """
+    if key in CT_TEMPLATES:
+        return CT_TEMPLATES[key]()
+    return np.ones((int(key), int(key), int(key)), dtype=np.int)
+
+
+def setup_case(name, key):
+    """
+    This function builds the inputs of a benchmark case. Nothing done here is timed.
+    :param name: string. name of the case, a key of CASES
+    :param key: lattice size (integer), name of a CT template or None for the single voxel cases
+    :return: function running the timed part of the case
+    """
+    sw, cf, pitch = STRUT_WIDTH, CHAMFER_FACTOR, PITCH
+    if name == 'voxel':
+        return lambda: voxel(sw, cf, pitch)
+    if name == 'half_voxel':
+        return lambda: half_voxel(sw, cf, pitch)
+    if name == 'hybrid_voxel':
+        return lambda: hybrid_voxel(sw, cf, pitch, 2 * sw)
+
+    if name == 'box_array':
+        n = int(key)
+        one_voxel = voxel(sw, cf, pitch)
+        return lambda: box_array(one_voxel, pitch, n, n, n)
+    if name == 'box_cap':
+        n = int(key)
+        open_lattice = box_array(voxel(sw, cf, pitch), pitch, n, n, n)
+        return lambda: box_cap(open_lattice, sw, cf, pitch, n, n, n)
+    if name == 'compression_specimen':
+        n = int(key)
+        return lambda: compression_specimen(sw, cf, pitch, n, n, n)
+    if name == 'combine_meshes':
+        # n layers of n x n voxels stacked in z, the way layered structures are put together
+        n = int(key)
+        layer = box_array(voxel(sw, cf, pitch), pitch, n, n, 1)
+        layers = [layer]
+        for k in range(1, n):
+            layers.append(mesh.Mesh(layer.data.copy(), calculate_normals=False))
+            translate(layers[-1], np.array([0, 0, k * pitch]))
+        return lambda: combine_meshes(*layers)
+
+    template = _template(key)
+    if name == 'lattice_codedstructure':
+        one_voxel = voxel(sw, cf, pitch)
+        capmesh = cap_cuboct(sw, cf)
+        template = (template > 0).astype(np.int)
+        return lambda: lattice_codedstructure(one_voxel, capmesh, pitch, template)
+    if name == 'hybrid_codedstructure':
+        voxel_meshes, voxel_cap_geos = _hybrid_inputs()
+        return lambda: hybrid_codedstructure(template, pitch, voxel_meshes, voxel_cap_geos)
+    raise ValueError('Unknown benchmark case ' + name)
+
+
+# Benchmark cases and what they are run over: None for a single run, 'sizes' for SIZES, 'templates' for SIZES and
+# the CT templates
+CASES = collections.OrderedDict([
+    ('voxel', None),
+    ('half_voxel', None),
+    ('hybrid_voxel', None),
+    ('box_array', 'sizes'),
+    ('box_cap', 'sizes'),
+    ('compression_specimen', 'sizes'),
+    ('combine_meshes', 'sizes'),
+    ('lattice_codedstructure', 'templates'),
+    ('hybrid_codedstructure', 'templates'),
+])
+
+
+def _peak_rss():
+    """
+    :return: peak resident memory of this process in bytes, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+
+def run_case(name, key):
+    """
+    This function runs one benchmark case in this process. It is run in a fresh interpreter by benchmark(), so that the
+    peak memory and the primitive caches belong to this case alone.
+    :return: dictionary of the measurements
+    """
+    run = setup_case(name, key)
+    setup_rss = _peak_rss()
+    start = time.time()
+    result = run()
+    seconds = time.time() - start
+    return {'seconds': seconds, 'facets': len(result.data), 'setup_peak_rss': setup_rss, 'peak_rss': _peak_rss()}
+
+
+def case_keys(name, max_size=None):
+    """
+    :param name: string. name of the case, a key of CASES
+    :param max_size: optional integer. largest lattice size to run
+    :return: list of the keys the case is run over
+    """
+    sweep = CASES[name]
+    if sweep is None:
+        return [None]
+    keys = [size for size in SIZES if max_size is None or size <= max_size]
+    if sweep == 'templates':
+        keys += sorted(CT_TEMPLATES)
+    return keys
+
+
+def benchmark(names=None, max_size=None, timeout=None):
+    """
+    This function runs benchmark cases, each in its own interpreter.
+    :param names: optional list of case names. Default is every case in CASES
+    :param max_size: optional integer. largest lattice size to run
+    :param timeout: optional float. seconds after which a case is stopped and reported as timed out
+    :return: list of dictionaries, one per case run. status is 'ok', 'failed' or 'timeout'
+    """
+    env = dict(os.environ)
+    env.pop('CUBOCT_CACHE_DIR', None)  # measure the generation, not the disk cache
+    results = []
+    for name in names or list(CASES):
+        for key in case_keys(name, max_size):
+            record = {'case': name, 'size': key if not isinstance(key, str) else None,
+                      'template': key if isinstance(key, str) else None}
+            print ("%s %s" % (name, '' if key is None else key))
+            command = [sys.executable, os.path.abspath(__file__), '--run', name, json.dumps(key)]
+            # Output goes to files rather than pipes, a case printing a lot would otherwise block on a full pipe
+            stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+            process = subprocess.Popen(command, stdout=stdout, stderr=stderr, env=env,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+            start = time.time()
+            while process.poll() is None and (timeout is None or time.time() - start < timeout):
+                time.sleep(0.05)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+                record['status'] = 'timeout'
+            else:
+                stdout.seek(0)
+                stderr.seek(0)
+                output = stdout.read().decode()
+                if process.returncode == 0:
+                    record.update(json.loads(output.splitlines()[-1]))
+                    record['status'] = 'ok'
+                else:
+                    record['status'] = 'failed'
+                    record['error'] = stderr.read().decode().strip().splitlines()[-1:]
+            results.append(record)
+    return results
+
+
+def _git_revision():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time CuboctSTL generators and record their peak memory.')
+    parser.add_argument('cases', nargs='*', help='cases to run, default all of: ' + ', '.join(CASES))
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON file to write results to')
+    parser.add_argument('--max-size', type=int, help='largest lattice size to run')
+    parser.add_argument('--timeout', type=float, help='seconds allowed per case')
+    parser.add_argument('--run', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print (json.dumps(run_case(args.run[0], json.loads(args.run[1]))))
+        return
+
+    results = benchmark(args.cases, args.max_size, args.timeout)
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'revision': _git_revision(),
+              'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'parameters': {'strut_width': STRUT_WIDTH, 'chamfer_factor': CHAMFER_FACTOR, 'pitch': PITCH},
+              'results': results}
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+    print ("Wrote %d results to %s" % (len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -89,18 +89,8 @@ def main():
     template_1 = ct_template3()
     capmesh = cap_cuboct(sw, cf)
 
-    # make all side caps that we will use in defining capping for half-voxel
-    cap_geo_top = mesh.Mesh(capmesh.data.copy())
-    cap_geo_top.rotate([1, 0, 0], math.radians(180))  # rotate so normal vectors correct
-    cap_geo_bottom = mesh.Mesh(capmesh.data.copy())
-    cap_geo_right = mesh.Mesh(capmesh.data.copy())
-    cap_geo_right.rotate([0, 1, 0], math.radians(90))
-    cap_geo_left = mesh.Mesh(capmesh.data.copy())
-    cap_geo_left.rotate([0, 1, 0], math.radians(270))
-    cap_geo_back = mesh.Mesh(capmesh.data.copy())
-    cap_geo_back.rotate([1, 0, 0], math.radians(270))
-    cap_geo_front = mesh.Mesh(capmesh.data.copy())
-    cap_geo_front.rotate([1, 0, 0], math.radians(90))
+    # get all side caps that we will use in defining capping for half-voxel
+    [cap_geo_top, cap_geo_bottom, cap_geo_right, cap_geo_left, cap_geo_back, cap_geo_front] = cap_library(sw, cf)
 
     # this definition of capping procedure will not cap the top of the voxel
     bottomhalf_caps = [0, cap_geo_bottom, cap_geo_right, cap_geo_left, cap_geo_back, cap_geo_front]
@@ -110,7 +100,13 @@ def main():
                                       [capmesh, bottomhalf_caps, tophalf_caps])
     #auto_name=generate_ct_file_name(sw, cf, pitch, '_w_holes')
     auto_name = generate_ct_file_name(sw, cf, pitch)
-    structure.save('generated_stl_files/ct_specimens/' + auto_name)
+    with profiler.stage('save') as stage:
+        structure.save('generated_stl_files/ct_specimens/' + auto_name)
+        stage.count(len(structure.data))
+
+    if profiler.enabled:
+        for name, total in profiler.report().items():
+            print('{0}: {1:.3f} s, {2} facets'.format(name, total['seconds'], total['facets']))
 
 if __name__ == "__main__":
     main()
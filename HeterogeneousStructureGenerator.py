@@ -6,20 +6,11 @@ def hybrid_template1():
     y = 10
     z = 11
 
-    template = np.zeros((x, y, z), dtype=np.int)
-    template[:, :, :] = 1
-    template[1, :, :] = 2
-    template[3, :, :] = 2
-    template[5, :, :] = 2
-    template[7, :, :] = 2
-    template[9, :, :] = 2
-    template[:, 1, :] = 2
-    template[:, 3, :] = 2
-    template[:, 5, :] = 2
-    template[:, 7, :] = 2
-    template[:, 9, :] = 2
-
-    return template
+    # Type 1 voxels, with every odd x and y layer type 2
+    builder = TemplateBuilder((x, y, z), fill=1)
+    builder.add(Periodic('x', 2, phase=1) | Periodic('y', 2, phase=1), 2)
+
+    return builder.build()
 
 
 
@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+
+# Import time budget for CuboctSTL_v0 in seconds. Every generator script starts with "from CuboctSTL_v0 import *", so
+# this is paid by every batch job.
+IMPORT_BUDGET = 0.5
+
+# Modules that must not be loaded by importing CuboctSTL_v0. The plotting stack is only needed by preview_mesh.
+LAZY_MODULES = ['matplotlib', 'mpl_toolkits.mplot3d']
+
+_IMPORT_PROBE = """
+import sys
+import time
+start = time.time()
+from CuboctSTL_v0 import *
+print(repr(time.time() - start))
+print(','.join(sorted(name for name in %r if name in sys.modules)))
+"""
+
+
+def import_time(repeats=5):
+    """
+    This function measures how long "from CuboctSTL_v0 import *" takes in a fresh interpreter.
+    :param repeats: integer number of interpreters to time. The fastest run is kept, as the others only add noise
+    from the machine
+    :return: import time in seconds, list of the LAZY_MODULES that got loaded
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    loaded = []
+    for n in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_PROBE % LAZY_MODULES], cwd=directory)
+        lines = output.decode().splitlines()
+        times.append(float(lines[-2]))
+        loaded = [name for name in lines[-1].split(',') if name]
+    return min(times), loaded
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else IMPORT_BUDGET
+    seconds, loaded = import_time()
+    print ("CuboctSTL_v0 import: %.3f s (budget %.3f s)" % (seconds, budget))
+    failed = False
+    if seconds > budget:
+        print ("Import time is over budget")
+        failed = True
+    if loaded:
+        print ("Import loaded modules that should be lazy: " + ', '.join(loaded))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
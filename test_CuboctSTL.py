@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+from CuboctSTL_v0 import *
+
+
+def test_parallel_empty_template():
+    # A template with no voxels gives an empty mesh, or no facets written, with or without worker processes
+    template = np.zeros((3, 3, 3), dtype=np.int)
+    one_voxel = voxel(0.7, 5, 15)
+    capmesh = cap_cuboct(0.7, 5)
+
+    assert len(lattice_codedstructure(one_voxel, capmesh, 15, template, processes=2).data) == 0
+    assert len(hybrid_codedstructure(template, 15, [one_voxel], capmesh, processes=2).data) == 0
+
+    handle, path = tempfile.mkstemp(suffix='.stl')
+    os.close(handle)
+    try:
+        assert lattice_codedstructure(one_voxel, capmesh, 15, template, out=path, processes=2) == 0
+        assert len(mesh.Mesh.from_file(path).data) == 0
+    finally:
+        os.remove(path)
+
+
+def test_plan_counts_closed_template():
+    # The planned facet count is exact, the duplicates between voxels and their caps included
+    voxel_meshes = [closed_voxel(0.7, 5, 15), voxel(0.7, 5, 15), half_voxel(0.7, 5, 15)]
+    capmesh = cap_cuboct(0.7, 5)
+    caps = cap_library(0.7, 5)
+    voxel_cap_geos = [capmesh, capmesh, [0] + caps[1:]]
+    templates = [np.ones((1, 1, 1), dtype=np.int), np.ones((2, 1, 1), dtype=np.int),
+                 np.random.RandomState(0).randint(0, 4, size=(4, 3, 3))]
+    for template in templates:
+        planned = plan(template, 15, voxel_meshes, voxel_cap_geos)
+        built = hybrid_codedstructure(template, 15, voxel_meshes, voxel_cap_geos)
+        assert planned['facets'] == len(built.data)
+
+
+def test_plan_sparse_template():
+    # A SparseTemplate plans the same as the dense array it stands for, whatever its fill code
+    voxel_meshes = [voxel(0.7, 5, 15), half_voxel(0.7, 5, 15)]
+    capmesh = cap_cuboct(0.7, 5)
+    voxel_cap_geos = [capmesh, [0] + cap_library(0.7, 5)[1:]]
+    template = np.random.RandomState(1).choice([0, 1, 2], size=(5, 4, 3), p=[0.2, 0.6, 0.2])
+    for closed in [True, False]:
+        dense = plan(template, 15, voxel_meshes, voxel_cap_geos, closed=closed)
+        for fill in [0, 1]:
+            sparse = plan(SparseTemplate.from_dense(template, fill), 15, voxel_meshes, voxel_cap_geos, closed=closed)
+            assert sparse == dense
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print (name + ' passed')